@@ -1,13 +1,17 @@
 import argparse
+import collections
+import heapq
 import logging
+import re
 import sys
+import time
+from dataclasses import dataclass, field
 from datetime import timedelta
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 
-import rtoml
-from pydantic import BaseModel, FilePath, field_serializer
 from PySide6.QtCore import QDateTime, Qt, QTime, QTimer, QUrl
 from PySide6.QtGui import QIcon
 from PySide6.QtMultimedia import QAudioOutput, QMediaPlayer
@@ -27,7 +31,12 @@ from PySide6.QtWidgets import (
     QWidget,
 )
 
-from .utils import set_application_volume
+from .utils import VolumeSetter
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
 
 
 class Anchor(str, Enum):
@@ -36,34 +45,129 @@ class Anchor(str, Enum):
     end = "end"
 
 
-class Jingle(BaseModel):
-    file: FilePath
+OFFSET_HHMMSS = re.compile(
+    r"([-+])?(?:(\d+) ?(?:days?|d),? ?)?"
+    r"(?:([01]\d|2[0-3]):([0-5]\d)(?::([0-5]\d(?:\.\d+)?))?)?"
+)
+OFFSET_ISO8601 = re.compile(
+    r"([-+])?P(?:(\d+(?:\.\d+)?)D)?"
+    r"(?:T(?:(\d+(?:\.\d+)?)H)?(?:(\d+(?:\.\d+)?)M)?(?:(\d+(?:\.\d+)?)S)?)?"
+)
+
+
+def parse_offset(value: Any) -> timedelta:
+    """Parses an offset given in seconds, as `[-][D days, ]HH:MM[:SS[.f]]` or as
+    an ISO 8601 duration with days, hours, minutes and seconds (e.g., `-PT1M`).
+
+    As with pydantic, two colon-separated parts are hours and minutes:
+
+    >>> parse_offset("-01:00") == timedelta(hours=-1)
+    True
+    >>> parse_offset("-PT1M") == timedelta(minutes=-1)
+    True
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return timedelta(seconds=value)
+
+    if isinstance(value, str):
+        hhmmss = OFFSET_HHMMSS.fullmatch(value)
+        iso8601 = OFFSET_ISO8601.fullmatch(value)
+
+        if hhmmss and (hhmmss.group(2) or hhmmss.group(3)):
+            sign, days, hours, minutes, seconds = hhmmss.groups()
+        elif iso8601 and any(iso8601.groups()[1:]):
+            sign, days, hours, minutes, seconds = iso8601.groups()
+        else:
+            raise ValueError(f"invalid offset `{value}`")
+
+        offset = timedelta(
+            days=float(days or 0),
+            hours=float(hours or 0),
+            minutes=float(minutes or 0),
+            seconds=float(seconds or 0),
+        )
+        return -offset if sign == "-" else offset
+
+    raise ValueError(f"invalid offset `{value!r}`, expected seconds or a string")
+
+
+@dataclass
+class Jingle:
+    file: Path
     name: str = "Unnamed"
     offset: timedelta = timedelta(seconds=0.0)
     anchor: Anchor = Anchor.start
 
-    @field_serializer("file")
-    def serialize_file(self, file: FilePath, _info):
-        return file.as_posix()
+    def __post_init__(self):
+        if not self.file.is_file():
+            raise ValueError(f"Jingle file `{self.file}` does not exist")
 
-    @field_serializer("offset")
-    def serialize_offset(self, offset: timedelta, _info):
-        return offset.total_seconds()
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Jingle":
+        name = data.get("name", "Unnamed")
+
+        if "file" not in data:
+            raise ValueError(f"Jingle `{name}` has no `file` entry")
+
+        try:
+            offset = parse_offset(data.get("offset", 0.0))
+        except ValueError as e:
+            raise ValueError(f"Jingle `{name}` has an {e}") from e
+
+        try:
+            anchor = Anchor(data.get("anchor", "start"))
+        except ValueError as e:
+            raise ValueError(
+                f"Jingle `{name}` has an invalid anchor `{data['anchor']}`, "
+                f"expected one of: {', '.join(a.value for a in Anchor)}"
+            ) from e
+
+        return cls(
+            file=Path(data["file"]),
+            name=name,
+            offset=offset,
+            anchor=anchor,
+        )
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "file": self.file.as_posix(),
+            "name": self.name,
+            "offset": self.offset.total_seconds(),
+            "anchor": self.anchor.value,
+        }
 
-class Jingles(BaseModel):
-    jingles: List[Jingle] = []
+
+@dataclass
+class Jingles:
+    jingles: List[Jingle] = field(default_factory=list)
 
     def __iter__(self):
         return iter(self.jingles)
 
+    def __getitem__(self, index: int) -> Jingle:
+        return self.jingles[index]
+
     @classmethod
     def from_file(cls, path):
-        return cls.model_validate(rtoml.load(path))
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+
+        return cls(jingles=[Jingle.from_dict(x) for x in data.get("jingles", [])])
 
     def to_file(self, path) -> None:
         """Dumps the configuration to a file."""
-        rtoml.dump(self.model_dump(), path, pretty=True)
+        # Only needed for writing, so we do not pay its import at startup
+        import rtoml
+
+        rtoml.dump(
+            {"jingles": [jingle.to_dict() for jingle in self.jingles]},
+            path,
+            pretty=True,
+        )
+
+
+MAX_CHECK_INTERVAL_MSECS = 60_000
 
 
 def slider_value_as_percentage(slider: QSlider) -> float:
@@ -76,9 +180,24 @@ class QTextEditLogger(logging.Handler):
         self.widget = QPlainTextEdit(parent)
         self.widget.setReadOnly(True)
 
+        # Records are appended in batches, to repaint the widget only once
+        self._buf = collections.deque(maxlen=5000)
+        self._flush_timer = QTimer(self.widget)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(100)
+        self._flush_timer.timeout.connect(self._flush)
+
     def emit(self, record):
-        msg = self.format(record)
-        self.widget.appendPlainText(msg)
+        self._buf.append(self.format(record))
+
+        # Only wake up when there is something to show
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def _flush(self):
+        if self._buf:
+            self.widget.appendPlainText("\n".join(self._buf))
+            self._buf.clear()
 
 
 class JingleBox(QMainWindow):
@@ -108,6 +227,13 @@ class JingleBox(QMainWindow):
         game_duration = QTime.fromString("00:30:00", self.time_format)
         break_duration = QTime.fromString("00:05:00", self.time_format)
 
+        # Editing a field emits intermediate values, we only apply the last one
+        self._last_settings_key = None
+        self._settings_timer = QTimer(self)
+        self._settings_timer.setSingleShot(True)
+        self._settings_timer.setInterval(100)
+        self._settings_timer.timeout.connect(self.update_game_settings)
+
         game_settings = QGroupBox("Game settings")
         game_settings.setCheckable(True)
         grid = QGridLayout()
@@ -115,26 +241,28 @@ class JingleBox(QMainWindow):
         grid.addWidget(QLabel("First game at:"), 1, 1)
         self.start_datetime = QDateTimeEdit(start)
         self.start_datetime.dateTimeChanged.connect(
-            lambda _: self.update_game_settings()
+            lambda _: self._settings_timer.start()
         )
         self.start_datetime.setDisplayFormat(self.datetime_format)
         grid.addWidget(self.start_datetime, 1, 2)
 
         grid.addWidget(QLabel("Last game at:"), 2, 1)
         self.end_datetime = QDateTimeEdit(end)
-        self.end_datetime.dateTimeChanged.connect(lambda _: self.update_game_settings())
+        self.end_datetime.dateTimeChanged.connect(
+            lambda _: self._settings_timer.start()
+        )
         self.end_datetime.setDisplayFormat(self.datetime_format)
         grid.addWidget(self.end_datetime, 2, 2)
 
         grid.addWidget(QLabel("Game duration:"), 3, 1)
         self.game_duration = QTimeEdit(game_duration)
-        self.game_duration.timeChanged.connect(lambda _: self.update_game_settings())
+        self.game_duration.timeChanged.connect(lambda _: self._settings_timer.start())
         self.game_duration.setDisplayFormat(self.time_format)
         grid.addWidget(self.game_duration, 3, 2)
 
         grid.addWidget(QLabel("Break duration:"), 4, 1)
         self.break_duration = QTimeEdit(break_duration)
-        self.break_duration.timeChanged.connect(lambda _: self.update_game_settings())
+        self.break_duration.timeChanged.connect(lambda _: self._settings_timer.start())
         self.break_duration.setDisplayFormat(self.time_format)
         grid.addWidget(self.break_duration, 4, 2)
 
@@ -146,6 +274,16 @@ class JingleBox(QMainWindow):
         jingles_settings = QGroupBox(f"Jingles (from: {jingles_path})")
         self.jingles = Jingles.from_file(jingles_path)
 
+        # Offsets and anchors are fixed once loaded, so we only compute them once
+        self._offset_ms = [
+            int(jingle.offset.total_seconds() * 1000) for jingle in self.jingles
+        ]
+        anchor_idx = {Anchor.start: 0, Anchor.half: 1, Anchor.end: 2}
+        self._anchor_idx = [anchor_idx[jingle.anchor] for jingle in self.jingles]
+        self._jingle_urls = [
+            QUrl.fromLocalFile(jingle.file.as_posix()) for jingle in self.jingles
+        ]
+
         grid = QGridLayout()
 
         grid.addWidget(QLabel("Name"), 1, 1)
@@ -153,41 +291,30 @@ class JingleBox(QMainWindow):
         offset_label.setToolTip("Time offset w/ respect of the start of a game.")
         grid.addWidget(offset_label, 1, 2)
 
-        for i, jingle in enumerate(self.jingles, start=2):
+        icon = QIcon.fromTheme(
+            "media-playback-start.png",
+            self.style().standardIcon(QStyle.SP_MediaPlay),
+        )
+
+        for i, jingle in enumerate(self.jingles):
+            row = i + 2
             jingle_label = QLabel(jingle.name)
             jingle_label.setToolTip(f"Source: {jingle.file.as_posix()}")
-            grid.addWidget(jingle_label, i, 1)
+            grid.addWidget(jingle_label, row, 1)
 
             total_seconds = jingle.offset.total_seconds()
-
-            if total_seconds < 0:
-                total_seconds = -total_seconds
-                sign = "-"
-            else:
-                sign = "+"
-            hours = int(total_seconds // 3600)
-            minutes = int((total_seconds % 3600) // 60)
-            seconds = int((total_seconds % 3600) % 60)
+            sign = "-" if total_seconds < 0 else "+"
+            minutes, seconds = divmod(int(abs(total_seconds)), 60)
+            hours, minutes = divmod(minutes, 60)
             grid.addWidget(
-                QLabel(sign + f"{hours:02d}h:{minutes:02d}m:{seconds:02d}s"), i, 2
-            )
-
-            icon = QIcon.fromTheme(
-                "media-playback-start.png",
-                self.style().standardIcon(QStyle.SP_MediaPlay),
+                QLabel(f"{sign}{hours:02d}h:{minutes:02d}m:{seconds:02d}s"), row, 2
             )
 
-            def make_callback(self, file):
-                def callback():
-                    return self.play_jingle(file)
-
-                return callback
-
             button = QPushButton("")
             button.setIcon(icon)
 
-            button.clicked.connect(make_callback(self, jingle.file))
-            grid.addWidget(button, i, 3)
+            button.clicked.connect(partial(self.play_jingle, i))
+            grid.addWidget(button, row, 3)
 
         jingles_settings.setLayout(grid)
         layout.addWidget(jingles_settings, 2, 1)
@@ -195,6 +322,7 @@ class JingleBox(QMainWindow):
         # Sound setting
 
         self.muted = False
+        self.volume_setter = VolumeSetter()
 
         sound_info = QGroupBox("Sound settings")
         sound_info.setCheckable(True)
@@ -226,14 +354,25 @@ class JingleBox(QMainWindow):
         self.application_volume_muted_slider = QSlider(Qt.Horizontal)
         self.jingles_volume_slider = QSlider(Qt.Horizontal)
 
+        # Dragging a slider emits many values, only the last one is applied
+        self._vol_timer = QTimer(self)
+        self._vol_timer.setSingleShot(True)
+        self._vol_timer.setInterval(50)
+        self._vol_timer.timeout.connect(self.set_application_volume)
+
+        self._jingles_vol_timer = QTimer(self)
+        self._jingles_vol_timer.setSingleShot(True)
+        self._jingles_vol_timer.setInterval(50)
+        self._jingles_vol_timer.timeout.connect(self.set_jingles_volume)
+
         self.application_volume_slider.valueChanged.connect(
-            lambda _: self.set_application_volume()
+            lambda _: self._vol_timer.start()
         )
         self.application_volume_muted_slider.valueChanged.connect(
-            lambda _: self.set_application_volume()
+            lambda _: self._vol_timer.start()
         )
         self.jingles_volume_slider.valueChanged.connect(
-            lambda _: self.set_jingles_volume()
+            lambda _: self._jingles_vol_timer.start()
         )
 
         grid.addWidget(application_volume_label, 2, 1)
@@ -266,8 +405,6 @@ class JingleBox(QMainWindow):
             logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
         )
         logging.getLogger().addHandler(log_text_box)
-        # You can control the logging level
-        logging.getLogger().setLevel(logging.DEBUG)
         grid.addWidget(log_text_box.widget, 3, 1, 1, 2)
 
         game_info.setLayout(grid)
@@ -279,6 +416,7 @@ class JingleBox(QMainWindow):
         self.player = QMediaPlayer()
         self.player.setAudioOutput(self.audio_output)
         self.player.mediaStatusChanged.connect(self.update_application_volume)
+        self._preloaded_index: Optional[int] = None
 
         # Set audio levels
 
@@ -287,116 +425,175 @@ class JingleBox(QMainWindow):
         self.jingles_volume_slider.setValue(99)
 
         # Finish up
+
+        # Wakes up at the next game or jingle, see `schedule_next_check`
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.timeout.connect(self.check_for_jingle_and_game)
+
         self.update_game_settings()
         self.setCentralWidget(central_widget)
 
-        self.timer = QTimer()
-        self.timer.setInterval(500)
-        self.timer.timeout.connect(self.check_for_jingle_and_game)
-        self.timer.start()
+    def msecs_to_string(self, msecs: int) -> str:
+        """Formats msecs since epoch, only creating a QDateTime when displayed."""
+        return QDateTime.fromMSecsSinceEpoch(msecs).toString(self.datetime_format)
 
     def update_game_settings(self):
-        logging.debug("Game settings have changed, updating...")
-        now = QDateTime.currentDateTime()
-        end = self.end_datetime.dateTime()
+        key = (
+            self.start_datetime.dateTime().toMSecsSinceEpoch(),
+            self.end_datetime.dateTime().toMSecsSinceEpoch(),
+            self.game_duration.time().msecsSinceStartOfDay(),
+            self.break_duration.time().msecsSinceStartOfDay(),
+        )
 
-        if now >= end:
-            self.next_game_label.setText("no more games are planned")
+        if key == self._last_settings_key:
             return
 
-        self.games = []
-
-        start = self.start_datetime.dateTime()
-        game_duration_msecs = self.game_duration.time().msecsSinceStartOfDay()
-        break_duration_msecs = self.break_duration.time().msecsSinceStartOfDay()
+        logging.info("Game settings have changed, updating...")
+        now_ms = int(time.time() * 1000)
+        start_ms, end_ms, game_duration_msecs, break_duration_msecs = key
         time_between_games_msecs = game_duration_msecs + break_duration_msecs
 
-        while start < now:
-            # self.games.append(start)  # We don't add past games :-)
-            start = start.addMSecs(time_between_games_msecs)
+        # Zero-length games and breaks cannot be scheduled
+        if now_ms >= end_ms or time_between_games_msecs <= 0:
+            self.next_game_label.setText("no more games are planned")
+            self.games = []
+            self.update_jingles()
+            self._last_settings_key = key
+            return
 
-        # TODO: also update after each game ends
-        self.next_game_label.setText(start.toString(self.datetime_format))
+        if now_ms > start_ms:
+            # Skip all past games at once, we don't add them :-)
+            n = (
+                now_ms - start_ms + time_between_games_msecs - 1
+            ) // time_between_games_msecs
+            start_ms += n * time_between_games_msecs
 
-        while start < end:
-            self.games.append(start)
-            start = start.addMSecs(time_between_games_msecs)
+        # TODO: also update after each game ends
+        self.next_game_label.setText(self.msecs_to_string(start_ms))
 
-        self.games = self.games[::-1]  # Latest if first
+        # Latest is first
+        self.games = list(reversed(range(start_ms, end_ms, time_between_games_msecs)))
 
         self.update_jingles()
+        # Only recorded once applied, so that a failed update can be retried
+        self._last_settings_key = key
 
     def update_jingles(self):
         self.planned_jingles = []
-        now = QDateTime.currentDateTime()
+        now_ms = int(time.time() * 1000)
 
-        for game in self.games:
-            start = game
-            game_duration_msecs = self.game_duration.time().msecsSinceStartOfDay()
-            half = start.addMSecs(game_duration_msecs // 2)
-            end = start.addMSecs(game_duration_msecs)
+        self._game_duration_msecs = self.game_duration.time().msecsSinceStartOfDay()
+        anchors = (0, self._game_duration_msecs // 2, self._game_duration_msecs)
 
-            anchor_map = {
-                Anchor.start: start,
-                Anchor.half: half,
-                Anchor.end: end,
-            }
+        # Jingle times relative to the start of any game
+        self._relative_msecs = [
+            anchors[anchor_idx] + offset_ms
+            for anchor_idx, offset_ms in zip(self._anchor_idx, self._offset_ms)
+        ]
 
-            for jingle in self.jingles:
-                anchor = anchor_map[jingle.anchor]
-                anchor = anchor.addMSecs(int(jingle.offset.total_seconds() * 1000))
+        for game_ms in self.games:
+            self.planned_jingles.extend(self._plan_one_game(game_ms, now_ms))
 
-                if now > anchor:
-                    continue
+        # Earliest jingle is always on top of the heap
+        heapq.heapify(self.planned_jingles)
 
-                planned_jingle = (
-                    jingle.file,
-                    jingle.name,
-                    anchor,
-                )
-                self.planned_jingles.append(planned_jingle)
+        self.update_next_jingle_label()
+        self.preload_next_jingle()
+        self.schedule_next_check()
 
-        self.planned_jingles.sort(key=lambda p: p[2], reverse=True)
+    def _plan_one_game(self, game_ms: int, now_ms: int) -> List[Tuple[int, int]]:
+        """Returns the (msecs since epoch, jingle index) of the jingles to play
+        during the game starting at `game_ms`, ignoring the past ones."""
+        return [
+            (game_ms + relative_ms, i)
+            for i, relative_ms in enumerate(self._relative_msecs)
+            if game_ms + relative_ms >= now_ms
+        ]
 
-        # TODO: only update in one method
+    def update_next_jingle_label(self):
         if len(self.planned_jingles) > 0:
-            _, name, datetime = self.planned_jingles[-1]
+            anchor_ms, i = self.planned_jingles[0]
             self.next_jingle_label.setText(
-                datetime.toString(self.datetime_format) + f" ({name})"
+                self.msecs_to_string(anchor_ms) + f" ({self.jingles[i].name})"
             )
         else:
             self.next_jingle_label.setText("no more jingles are planned")
 
     def check_for_jingle_and_game(self):
-        now = QDateTime.currentDateTime()
+        # Plain ints, so that no Qt object is created on every tick
+        now_ms = int(time.time() * 1000)
 
-        if len(self.games) > 0 and now > self.games[-1]:
-            logging.debug("We entered a new game, updating next game info.")
+        if len(self.games) > 0 and now_ms > self.games[-1]:
+            logging.info("We entered a new game, updating next game info.")
             self.games.pop()
 
             if len(self.games) > 0:
-                self.next_game_label.setText(
-                    self.games[-1].toString(self.datetime_format)
-                )
+                self.next_game_label.setText(self.msecs_to_string(self.games[-1]))
             else:
                 self.next_game_label.setText("no more games are planned")
 
-        if len(self.planned_jingles) > 0 and now > self.planned_jingles[-1][2]:
+        # Jingles from games that are already over are dropped without playing
+        while (
+            len(self.planned_jingles) > 0
+            and self.planned_jingles[0][0] < now_ms - self._game_duration_msecs
+        ):
+            heapq.heappop(self.planned_jingles)
+
+        if len(self.planned_jingles) > 0 and now_ms > self.planned_jingles[0][0]:
             logging.debug("We play a new jingle and update next jingle info.")
-            file, _, _ = self.planned_jingles.pop()
-            self.play_jingle(file)
-
-            if len(self.planned_jingles) > 0:
-                _, name, datetime = self.planned_jingles[-1]
-                self.next_jingle_label.setText(
-                    datetime.toString(self.datetime_format) + f" ({name})"
-                )
-            else:
-                self.next_jingle_label.setText("no more jingles are planned")
+            _, i = heapq.heappop(self.planned_jingles)
+            self.play_jingle(i)
+            self.update_next_jingle_label()
+
+        self.schedule_next_check()
+
+    def schedule_next_check(self):
+        """Starts the timer so that it fires right after the next game or jingle."""
+        events = []
+
+        if len(self.games) > 0:
+            events.append(self.games[-1])
+
+        if len(self.planned_jingles) > 0:
+            events.append(self.planned_jingles[0][0])
+
+        if len(events) == 0:
+            self.timer.stop()
+            return
+
+        # Events are processed once strictly in the past
+        delay = min(events) - int(time.time() * 1000) + 1
+        # Also wake up regularly, in case the system clock changes
+        self.timer.start(min(max(delay, 0), MAX_CHECK_INTERVAL_MSECS))
+
+    def preload_next_jingle(self):
+        """Sets the next planned jingle as source, so playing it is immediate."""
+        if len(self.planned_jingles) == 0:
+            return
+
+        # Changing the source would stop the jingle currently playing
+        if self.player.playbackState() == QMediaPlayer.PlaybackState.PlayingState:
+            return
+
+        i = self.planned_jingles[0][1]
+
+        if i != self._preloaded_index:
+            self.player.setSource(self._jingle_urls[i])
+            self._preloaded_index = i
+
+    def play_jingle(self, i: int):
+        logging.info(
+            "Playing jingle %s from file: %s",
+            self.jingles[i].name,
+            self.jingles[i].file,
+        )
+
+        if i != self._preloaded_index:
+            self.player.setSource(self._jingle_urls[i])
+            self._preloaded_index = i
 
-    def play_jingle(self, file: Path):
-        logging.debug(f"Playing jingle from file: {file.as_posix()}")
-        self.player.setSource(QUrl.fromLocalFile(file.as_posix()))
         self.player.setPosition(0)
         self.muted = True
         self.player.play()
@@ -404,6 +601,7 @@ class JingleBox(QMainWindow):
     def update_application_volume(self, state):
         if state == QMediaPlayer.MediaStatus.EndOfMedia:
             self.muted = False
+            self.preload_next_jingle()
 
         self.set_application_volume()
 
@@ -415,7 +613,7 @@ class JingleBox(QMainWindow):
         else:
             volume = slider_value_as_percentage(self.application_volume_slider)
 
-        set_application_volume(application, volume)
+        self.volume_setter(application, volume)
 
     def set_jingles_volume(self):
         volume = slider_value_as_percentage(self.jingles_volume_slider)
@@ -433,8 +631,17 @@ def main():
         default=Path("jingles.example.toml"),
         help="Path to jingles' configuration. Defaults to jingles.example.toml",
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Also log debug messages.",
+    )
     args = parser.parse_args()
 
+    # You can control the logging level
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
     if not QApplication.instance():
         app = QApplication(sys.argv)
     else:
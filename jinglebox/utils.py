@@ -1,23 +1,101 @@
-from pulsectl import Pulse
+import logging
+from typing import TYPE_CHECKING, Optional
 
+if TYPE_CHECKING:
+    from pulsectl import Pulse
 
-def set_application_volume(application: str, volume: float) -> float:
-    with Pulse("set-application-volume") as pulse:
-        sinks = pulse.sink_input_list()
 
-        try:
-            sink = next(
-                sink for sink in sinks if application.lower() in sink.name.lower()
-            )
+class VolumeSetter:
+    """Sets the volume of an application, reusing the same PulseAudio client and
+    the sink input found on previous calls."""
+
+    def __init__(self):
+        self._pulse: Optional["Pulse"] = None
+        self._pulse_available = True
+        self._sink_index: Optional[int] = None
+        self._app_lower: Optional[str] = None
+
+    @property
+    def pulse(self) -> Optional["Pulse"]:
+        # pulsectl loads libpulse, so we only import it when first needed
+        if self._pulse is None and self._pulse_available:
+            try:
+                from pulsectl import Pulse
+            except (ImportError, OSError) as e:
+                logging.warning("Cannot change application volume: %s", e)
+                self._pulse_available = False
+            else:
+                self._pulse = Pulse("jinglebox")
+
+        return self._pulse
+
+    def _reset(self) -> None:
+        """Closes the client, so that the next call opens a new connection."""
+        if self._pulse is not None:
+            self._pulse.close()
 
-            volume_struct = sink.volume
-            previous_volume = volume_struct.value_flat
-            volume_struct.value_flat = volume
+        self._pulse = None
+        self._sink_index = None
 
-            pulse.volume_set(sink, volume_struct)
-            return previous_volume
+    def _find_sink(self, pulse: "Pulse", application: str):
+        sinks = pulse.sink_input_list()
+        app_lower = application.lower()
 
+        try:
+            sink = next(sink for sink in sinks if app_lower in sink.name.lower())
         except StopIteration as e:
+            self._sink_index = None
             raise ValueError(
                 f"Application name `{application}` was not found in {sinks}"
             ) from e
+
+        self._sink_index = sink.index
+        self._app_lower = app_lower
+        return sink
+
+    def _set_volume(self, pulse: "Pulse", application: str, volume: float) -> float:
+        from pulsectl import PulseError
+
+        sink = None
+
+        if self._sink_index is not None and application.lower() == self._app_lower:
+            try:
+                sink = pulse.sink_input_info(self._sink_index)
+            except PulseError:
+                pass  # Sink input is gone, e.g., the application was restarted
+
+        if sink is None:
+            sink = self._find_sink(pulse, application)
+
+        volume_struct = sink.volume
+        previous_volume = volume_struct.value_flat
+        volume_struct.value_flat = volume
+
+        pulse.volume_set(sink, volume_struct)
+        return previous_volume
+
+    def __call__(self, application: str, volume: float) -> Optional[float]:
+        """Sets the volume of the application and returns its previous volume,
+        or None if PulseAudio is not available."""
+        if self._pulse is not None and not self._pulse.connected:
+            self._reset()
+
+        pulse = self.pulse
+
+        if pulse is None:
+            return None
+
+        from pulsectl import PulseDisconnected, PulseError
+        from pulsectl._pulsectl import LibPulse
+
+        try:
+            return self._set_volume(pulse, application, volume)
+        except (PulseError, PulseDisconnected, LibPulse.CallError):
+            # The server may have been restarted, so we retry with a new client
+            self._reset()
+            pulse = self.pulse
+
+            if pulse is None:
+                return None
+
+            return self._set_volume(pulse, application, volume)